@@ -2,11 +2,26 @@
 from pathlib import Path
 import os
 import sys
-import io
+import hashlib
 import json
+import re
+import shutil
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from itertools import islice
+from typing import Iterator
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+
+# streaming opcional do JSON da API (pip install ijson); sem ele, usa json.loads
+try:
+    import ijson
+except ImportError:
+    ijson = None
+from . import processor, summarizer
 from .processor import interpretar_afd, salvar_json_interpretacao, exportar_marcacoes_tipo3_csv
 from .summarizer import gerar_jornadas_por_cpf  # resumo por CPF/dia com duas colunas de extra
 
@@ -21,10 +36,28 @@ API_DOMAIN = os.getenv("API_DOMAIN")
 ID_EQUIP = os.getenv("ID_EQUIPAMENTO", "1")
 DATA_INI = os.getenv("DATA_INI", "2025-07-01")
 DATA_FIM = os.getenv("DATA_FIM", "2025-07-31")
+DEBUG_DUMP = os.getenv("AFD_DEBUG") == "1"
+MAX_DOWNLOADS = int(os.getenv("MAX_DOWNLOADS", "4"))  # downloads simultâneos (1 por mês)
 
 LOGIN_URL = f"{API_BASE}/login"
 DOWNLOAD_URL = f"{API_BASE}/report/afd_coletor_marcacao/download"
 EXPORT_DIR = Path("export")
+CACHE_DIR = EXPORT_DIR / ".cache"  # última saída de cada arquivo + hash de entrada (desligue com --no-cache)
+CHUNK_SIZE = 1024 * 1024  # 1 MiB por leitura/escrita no download
+
+# Sessão única: login e download reaproveitam a mesma conexão (TCP+TLS keep-alive)
+SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    # raise_on_status=False: esgotadas as tentativas, o último 5xx volta como resposta
+    # normal e cai no tratamento de erro do download (com os artefatos de diagnóstico)
+    max_retries=Retry(
+        total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False
+    ),
+)
+SESSION.mount("https://", _ADAPTER)
+SESSION.mount("http://", _ADAPTER)
 
 # -------------------------
 # Utilitários
@@ -39,43 +72,124 @@ def debug_write(name: str, content: bytes | str):
         p.write_bytes(content)
     return p
 
-def _try_extract_afd_from_json_bytes(content: bytes) -> tuple[bool, bytes]:
+# linha de AFD: 9 dígitos (NSR) + tipo na 10ª coluna
+_AFD_LINE_RE = re.compile(r"^[0-9]{9}[12345679]", re.M)
+
+def _iter_json_strings(path: Path) -> Iterator[str]:
+    """
+    Percorre os valores string do JSON em profundidade, sem recursão.
+    Com `ijson` instalado, lê o arquivo em streaming sem montar a árvore.
+    """
+    if ijson is not None:
+        with path.open("rb") as f:
+            for _, event, value in ijson.parse(f):
+                if event == "string":
+                    yield value
+        return
+
+    stack = [json.loads(path.read_bytes().decode("utf-8", errors="ignore"))]
+    while stack:
+        o = stack.pop()
+        if isinstance(o, str):
+            yield o
+        elif isinstance(o, dict):
+            stack.extend(reversed(list(o.values())))
+        elif isinstance(o, list):
+            stack.extend(reversed(o))
+
+def _try_extract_afd_from_json(path: Path) -> tuple[bool, bytes]:
     """
     Tenta encontrar, dentro de um JSON, uma string que seja o AFD (múltiplas linhas
     começando com 9 dígitos + tipo na 10ª coluna). Retorna (encontrou, afd_bytes).
     """
     try:
-        obj = json.loads(content.decode("utf-8", errors="ignore"))
-    except Exception:
-        return (False, b"")
-
-    def walk(o):
-        if isinstance(o, str):
-            lines = o.replace("\r\n", "\n").split("\n")
-            hits = 0
-            for ln in lines:
-                if len(ln) >= 10 and ln[:9].isdigit() and ln[9] in "12345679":
-                    hits += 1
+        for candidate in _iter_json_strings(path):
+            # basta achar 3 linhas; a varredura fica no regex (C)
+            hits = sum(1 for _ in islice(_AFD_LINE_RE.finditer(candidate), 3))
             if hits >= 3:
                 # o AFD deve ser ISO-8859-1; salvamos como latin-1
-                return o.encode("latin-1", errors="ignore")
-        elif isinstance(o, dict):
-            for v in o.values():
-                found = walk(v)
-                if found:
-                    return found
-        elif isinstance(o, list):
-            for v in o:
-                found = walk(v)
-                if found:
-                    return found
-        return None
-
-    afd = walk(obj)
-    if afd:
-        return (True, afd)
+                return (True, candidate.encode("latin-1", errors="ignore"))
+    except Exception:
+        pass
     return (False, b"")
 
+def _hash_arquivo(path: Path, *extras: bytes) -> str:
+    """blake2b do conteúdo (lido em blocos) + dados extras que também invalidam o cache."""
+    h = hashlib.blake2b(digest_size=16)
+    with path.open("rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            h.update(chunk)
+    for extra in extras:
+        h.update(extra)
+    return h.hexdigest()
+
+def _fonte(mod) -> bytes:
+    # o código do módulo entra na chave: mudou o parser/resumo, o cache antigo não vale
+    return Path(mod.__file__).read_bytes()
+
+def _gravar_atomico(dst: Path, dados: bytes) -> None:
+    tmp = dst.with_name(dst.name + ".tmp")
+    tmp.write_bytes(dados)
+    os.replace(tmp, dst)
+
+def _cache_get(out: Path, chave: str) -> bool:
+    """Restaura `out` do cache se a chave guardada ao lado dele for `chave`."""
+    dados, arq_chave = CACHE_DIR / out.name, CACHE_DIR / f"{out.name}.key"
+    try:
+        if arq_chave.read_text(encoding="ascii") != chave:
+            return False
+        shutil.copyfile(dados, out)
+    except OSError:
+        return False
+    return True
+
+def _cache_put(out: Path, chave: str) -> None:
+    """
+    Guarda `out` no cache: uma entrada por nome de saída (o conteúdo + a chave),
+    então um AFD novo substitui o anterior em vez de acumular arquivos.
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    arq_chave = CACHE_DIR / f"{out.name}.key"
+    # a chave antiga sai antes: se cair no meio, fica só um miss, nunca dado trocado
+    arq_chave.unlink(missing_ok=True)
+    _gravar_atomico(CACHE_DIR / out.name, out.read_bytes())
+    _gravar_atomico(arq_chave, chave.encode("ascii"))
+
+def _janelas_mensais(data_ini: str, data_fim: str) -> list[tuple[str, str]]:
+    """Quebra o período em janelas de um mês civil (datas ISO, inclusivas)."""
+    ini, fim = date.fromisoformat(data_ini), date.fromisoformat(data_fim)
+    if ini > fim:
+        raise RuntimeError(f"Período inválido: DATA_INI ({data_ini}) depois de DATA_FIM ({data_fim})")
+    janelas: list[tuple[str, str]] = []
+    while ini <= fim:
+        prox_mes = (ini.replace(day=1) + timedelta(days=32)).replace(day=1)
+        ate = min(fim, prox_mes - timedelta(days=1))
+        janelas.append((ini.isoformat(), ate.isoformat()))
+        ini = prox_mes
+    return janelas
+
+def _com_janela(nome: str, janela: str) -> str:
+    """Acrescenta a janela ao nome do arquivo (evita colisão entre downloads paralelos)."""
+    if janela in nome:
+        return nome
+    p = Path(nome)
+    return f"{p.stem}_{janela}{p.suffix}"
+
+def _debug_headers(prefix: str, headers) -> Path:
+    return debug_write(f"{prefix}_headers.txt", "\n".join(f"{k}: {v}" for k, v in headers.items()))
+
+def _mover_corpo(body_path: Path, dst: Path) -> None:
+    # com AFD_DEBUG o corpo bruto é preservado; sem, o temporário vira o arquivo final
+    if DEBUG_DUMP:
+        shutil.copyfile(body_path, dst)
+    else:
+        os.replace(body_path, dst)
+
+def _pick_inner(names: list[str]) -> str:
+    """Primeiro .txt/.dat do ZIP (ou o primeiro membro, se não houver)."""
+    preferred = [n for n in names if n.lower().endswith((".txt", ".dat"))] or names
+    return preferred[0]
+
 # -------------------------
 # Autenticação e Download
 # -------------------------
@@ -86,7 +200,7 @@ def get_token() -> str:
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
     payload = {"email": API_EMAIL, "password": API_PASSWORD, "domain": API_DOMAIN}
 
-    r = requests.post(LOGIN_URL, json=payload, headers=headers, timeout=60)
+    r = SESSION.post(LOGIN_URL, json=payload, headers=headers, timeout=60)
     try:
         r.raise_for_status()
     except requests.HTTPError:
@@ -111,9 +225,11 @@ def download_afd(token: str, id_equip: str, data_ini: str, data_fim: str) -> Pat
     """
     Baixa o AFD. Lida com:
     - JSON: tenta extrair texto do AFD de dentro do JSON
-    - ZIP: salva e extrai primeiro .txt/.dat
+    - ZIP: extrai primeiro .txt/.dat (o .zip só é mantido com AFD_DEBUG=1)
     - TXT/DAT: salva direto
-    Sempre salva artefatos de depuração em export/.
+    O corpo vai direto para disco em blocos, sem juntar a resposta inteira em memória.
+    Artefatos de depuração (export/last_response_<ini>_a_<fim>_headers.txt e .bin)
+    só com AFD_DEBUG=1 — ou sempre que o servidor responde com erro.
     """
     headers = {"Authorization": f"Bearer {token}", "Accept": "*/*"}
     params = {"idEquipamento": str(id_equip), "dataIni": data_ini, "dataFinal": data_fim}
@@ -121,109 +237,164 @@ def download_afd(token: str, id_equip: str, data_ini: str, data_fim: str) -> Pat
     EXPORT_DIR.mkdir(parents=True, exist_ok=True)
     print(f"[DEBUG] cwd={Path.cwd().resolve()} -> export={EXPORT_DIR.resolve()}")
 
-    with requests.get(DOWNLOAD_URL, headers=headers, params=params, timeout=180, stream=True) as r:
-        # headers e corpo (bruto/texto) para diagnóstico
-        debug_write("last_response_headers.txt", "\n".join(f"{k}: {v}" for k, v in r.headers.items()))
-        content = b"".join(r.iter_content(262_144) or b"")
-        debug_write("last_response.bin", content)
+    with SESSION.get(DOWNLOAD_URL, headers=headers, params=params, timeout=180, stream=True) as r:
+        # nomes por janela: downloads paralelos não sobrescrevem uns aos outros
+        janela = f"{id_equip}_{data_ini}_a_{data_fim}"
+        debug_prefix = f"last_response_{data_ini}_a_{data_fim}"
+        if DEBUG_DUMP:
+            _debug_headers(debug_prefix, r.headers)
+        # com AFD_DEBUG o corpo bruto fica em last_response_*.bin; sem, é só um .part temporário
+        body_path = EXPORT_DIR / (f"{debug_prefix}.bin" if DEBUG_DUMP else f"afd_download_{janela}.part")
+        head = b""
         try:
-            debug_write("last_response.txt", content.decode("latin-1"))
-        except Exception:
-            pass
+            # streaming dentro do try: conexão caída ou erro de escrita também limpa o .part
+            with body_path.open("wb") as fb:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    if not head:
+                        head = chunk[:4]  # bytes mágicos p/ detectar ZIP
+                    fb.write(chunk)
+
+            return _salvar_afd_baixado(r, body_path, head, janela, debug_prefix)
+        finally:
+            if not DEBUG_DUMP:
+                body_path.unlink(missing_ok=True)
+
+def _salvar_afd_baixado(
+    r: requests.Response, body_path: Path, head: bytes, janela: str, debug_prefix: str
+) -> Path:
+    """Decide o formato da resposta já gravada em `body_path` e gera o AFD final."""
+    if r.status_code >= 400:
+        # no erro, os artefatos de diagnóstico são gravados mesmo sem AFD_DEBUG
+        if not DEBUG_DUMP:
+            _debug_headers(debug_prefix, r.headers)
+            os.replace(body_path, EXPORT_DIR / f"{debug_prefix}.bin")
+        raise RuntimeError(
+            f"Erro no download ({r.status_code}). Veja export/{debug_prefix}_headers.txt e .bin"
+        )
 
-        if r.status_code >= 400:
+    dispo = r.headers.get("Content-Disposition", "")
+    ctype = (r.headers.get("Content-Type") or "").lower()
+
+    # 1) JSON -> tentar extrair AFD
+    if "json" in ctype:
+        ok, afd_bytes = _try_extract_afd_from_json(body_path)
+        if ok:
+            out_path = EXPORT_DIR / f"afd_extraido_{janela}.dat"
+            out_path.write_bytes(afd_bytes)
+            print(f"[DEBUG] AFD extraído de JSON: {out_path}")
+            return out_path
+        else:
+            # salvar o JSON para inspeção
+            jp = EXPORT_DIR / f"afd_api_response_{janela}.json"
+            _mover_corpo(body_path, jp)
             raise RuntimeError(
-                f"Erro no download ({r.status_code}). Veja export/last_response_headers.txt e .bin/.txt"
+                f"A resposta é JSON, mas não encontrei uma string AFD. Salvei {jp.name}. "
+                "Abra-o e me informe as chaves para ajustarmos o extrator."
             )
 
-        dispo = r.headers.get("Content-Disposition", "")
-        ctype = (r.headers.get("Content-Type") or "").lower()
-
-        # 1) JSON -> tentar extrair AFD
-        if "json" in ctype:
-            ok, afd_bytes = _try_extract_afd_from_json_bytes(content)
-            if ok:
-                out_path = EXPORT_DIR / f"afd_extraido_{id_equip}_{data_ini}_a_{data_fim}.dat"
-                out_path.write_bytes(afd_bytes)
-                print(f"[DEBUG] AFD extraído de JSON: {out_path}")
-                return out_path
-            else:
-                # salvar o JSON para inspeção
-                jp = EXPORT_DIR / f"afd_api_response_{id_equip}_{data_ini}_a_{data_fim}.json"
-                jp.write_bytes(content)
-                raise RuntimeError(
-                    f"A resposta é JSON, mas não encontrei uma string AFD. Salvei {jp.name}. "
-                    "Abra-o e me informe as chaves para ajustarmos o extrator."
-                )
-
-        # 2) ZIP -> salvar e extrair primeiro .txt/.dat
-        is_zip = (
-            "zip" in ctype
-            or (len(content) >= 2 and content[:2] == b"PK")
-            or ("filename=" in dispo and dispo.lower().endswith(".zip"))
-        )
-        if is_zip:
-            zip_path = EXPORT_DIR / (dispo.split("filename=")[-1].strip('"; ') if "filename=" in dispo else "afd_download.zip")
-            zip_path.write_bytes(content)
-            with zipfile.ZipFile(io.BytesIO(content)) as zf:
-                names = zf.namelist()
-                preferred = [n for n in names if n.lower().endswith((".txt", ".dat"))] or names
-                inner = preferred[0]
-                extracted_path = EXPORT_DIR / Path(inner).name
-                with zf.open(inner) as f:
-                    extracted_path.write_bytes(f.read())
-            print(f"[DEBUG] ZIP salvo: {zip_path} | Extraído: {extracted_path}")
-            return extracted_path
-
-        # 3) TXT/DAT puro
-        filename = f"afd_marcacao_{id_equip}_{data_ini}_a_{data_fim}"
-        if "filename=" in dispo:
-            filename = dispo.split("filename=")[-1].strip('"; ')
-        if "." not in Path(filename).name:
-            if "text" in ctype or "plain" in ctype:
-                filename += ".txt"
-            else:
-                filename += ".dat"
-        out_path = EXPORT_DIR / filename
-        out_path.write_bytes(content)
-        print(f"[DEBUG] AFD salvo: {out_path}")
-        return out_path
+    # 2) ZIP -> salvar e extrair primeiro .txt/.dat
+    is_zip = (
+        "zip" in ctype
+        or head[:2] == b"PK"
+        or ("filename=" in dispo and dispo.lower().endswith(".zip"))
+    )
+    if is_zip:
+        # lê o membro direto do corpo já em disco, sem materializá-lo em memória
+        with zipfile.ZipFile(body_path) as zf:
+            inner = _pick_inner(zf.namelist())
+            extracted_path = EXPORT_DIR / _com_janela(Path(inner).name, janela)
+            with zf.open(inner) as src, extracted_path.open("wb") as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        if DEBUG_DUMP:
+            zip_name = dispo.split("filename=")[-1].strip('"; ') if "filename=" in dispo else "afd_download.zip"
+            zip_path = EXPORT_DIR / _com_janela(zip_name, janela)
+            shutil.copyfile(body_path, zip_path)
+            print(f"[DEBUG] ZIP salvo: {zip_path}")
+        print(f"[DEBUG] Extraído do ZIP: {extracted_path}")
+        return extracted_path
+
+    # 3) TXT/DAT puro
+    filename = f"afd_marcacao_{janela}"
+    if "filename=" in dispo:
+        filename = dispo.split("filename=")[-1].strip('"; ')
+    if "." not in Path(filename).name:
+        if "text" in ctype or "plain" in ctype:
+            filename += ".txt"
+        else:
+            filename += ".dat"
+    out_path = EXPORT_DIR / _com_janela(filename, janela)
+    _mover_corpo(body_path, out_path)
+    print(f"[DEBUG] AFD salvo: {out_path}")
+    return out_path
+
+def download_afds(token: str, id_equip: str, janelas: list[tuple[str, str]]) -> list[Path]:
+    """
+    Baixa várias janelas em paralelo (threads sobre a SESSION compartilhada).
+    Retorna os arquivos na mesma ordem de `janelas`.
+    """
+    if len(janelas) == 1:
+        return [download_afd(token, id_equip, *janelas[0])]
+    workers = max(1, min(MAX_DOWNLOADS, len(janelas)))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(lambda j: download_afd(token, id_equip, *j), janelas))
 
 # -------------------------
 # Orquestração
 # -------------------------
+def processar_afd(afd_file: Path, sufixo: str = "", usar_cache: bool = True) -> None:
+    out_json = EXPORT_DIR / f"interpretacao{sufixo}.json"
+    chave_json = _hash_arquivo(afd_file, _fonte(processor))
+    if usar_cache and _cache_get(out_json, chave_json):
+        print(f"AFD {afd_file.name} sem mudanças: usando interpretação em cache")
+        data = json.loads(out_json.read_text(encoding="utf-8"))
+    else:
+        print(f"Interpretando AFD {afd_file.name}…")
+        data = interpretar_afd(afd_file)
+        salvar_json_interpretacao(data, out_json)
+        _cache_put(out_json, chave_json)
+
+    out_csv = exportar_marcacoes_tipo3_csv(data, EXPORT_DIR / f"marcacoes_tipo3{sufixo}.csv")
+
+    # ---- Resumo por CPF/dia (pares, total, extras >10h e >6h) ----
+    n_pares = 4                 # mude p/ 2 se quiser menos colunas
+    ordenar_por = "data_cpf"    # garante ordenação por data e CPF
+    out_resumo = EXPORT_DIR / f"jornadas_por_cpf{sufixo}.csv"
+    chave_resumo = _hash_arquivo(out_csv, f"{n_pares}|{ordenar_por}".encode(), _fonte(summarizer))
+    if not (usar_cache and _cache_get(out_resumo, chave_resumo)):
+        gerar_jornadas_por_cpf(out_csv, out_resumo, n_pares=n_pares, ordenar_por=ordenar_por)
+        _cache_put(out_resumo, chave_resumo)
+
+    print("OK!")
+    print(f"- JSON: {out_json.resolve()}")
+    print(f"- CSV : {out_csv.resolve()}")
+    print(f"- Resumo por CPF/dia: {out_resumo.resolve()}")
+    print(f"- Validações: {data['validacoes']}")
+
 def main():
+    usar_cache = "--no-cache" not in sys.argv[1:]
     try:
+        # períodos com mais de um mês viram uma janela por mês, baixadas em paralelo;
+        # calculadas antes do login para um período inválido falhar sem tocar na API
+        janelas = _janelas_mensais(DATA_INI, DATA_FIM)
+
         print("Autenticando…")
         token = get_token()
 
-        print("Baixando AFD…")
-        afd_file = download_afd(token, ID_EQUIP, DATA_INI, DATA_FIM)
-        print(f"AFD salvo em: {afd_file.resolve()}")
-
-        print("Interpretando AFD…")
-        data = interpretar_afd(afd_file)
-
-        out_json = salvar_json_interpretacao(data, EXPORT_DIR / "interpretacao.json")
-        out_csv = exportar_marcacoes_tipo3_csv(data, EXPORT_DIR / "marcacoes_tipo3.csv")
-
-        # ---- Resumo por CPF/dia (pares, total, extras >10h e >6h) ----
-        out_resumo = gerar_jornadas_por_cpf(
-            EXPORT_DIR / "marcacoes_tipo3.csv",
-            EXPORT_DIR / "jornadas_por_cpf.csv",
-            n_pares=4,              # mude p/ 2 se quiser menos colunas
-            ordenar_por="data_cpf", # garante ordenação por data e CPF
-        )
+        print(f"Baixando AFD ({len(janelas)} janela(s))…")
+        afd_files = download_afds(token, ID_EQUIP, janelas)
+        for afd_file in afd_files:
+            print(f"AFD salvo em: {afd_file.resolve()}")
 
-        print("OK!")
-        print(f"- JSON: {out_json.resolve()}")
-        print(f"- CSV : {out_csv.resolve()}")
-        print(f"- Resumo por CPF/dia: {out_resumo.resolve()}")
-        print(f"- Validações: {data['validacoes']}")
+        for (ini, fim), afd_file in zip(janelas, afd_files):
+            # com uma janela só, mantém os nomes de saída de sempre
+            sufixo = "" if len(janelas) == 1 else f"_{ini}_a_{fim}"
+            processar_afd(afd_file, sufixo, usar_cache)
     except Exception as e:
         print(f"[ERRO] {e}", file=sys.stderr)
-        print("Veja também os arquivos em 'export/': last_response.* para diagnóstico.", file=sys.stderr)
+        print("Veja também os arquivos em 'export/': last_response_* para diagnóstico.", file=sys.stderr)
         sys.exit(1)
+    finally:
+        SESSION.close()
 
 if __name__ == "__main__":
     main()
@@ -1,29 +1,37 @@
 # src/processor.py
 from __future__ import annotations
-from dataclasses import dataclass, asdict
+from array import array
+from dataclasses import dataclass, asdict, fields
 from pathlib import Path
-from typing import List, Dict, Any, Tuple, Optional
+from typing import Callable, Iterable, List, Dict, Any, Tuple, Optional, NamedTuple
+from operator import attrgetter, itemgetter, le
 import json
 import re
 
+# serialização JSON nativa opcional (pip install orjson); sem ela, usa json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # =========================
 # Utilitários
 # =========================
 
-def _read_text_afd(path: Path) -> str:
-    raw = path.read_bytes()
-    return raw.decode("latin-1", errors="replace")
+def _read_bytes_afd(path: Path) -> bytes:
+    # o AFD é ISO-8859-1; as linhas ficam em bytes e só os campos são decodificados
+    return path.read_bytes()
 
-def _split_lines(s: str) -> List[str]:
-    s = s.replace("\r\n", "\n")
-    lines = s.split("\n")
-    return [ln for ln in lines if ln.strip()]
+# registro = linha que começa com NSR (9 dígitos) e tem ao menos o tipo; a
+# varredura do arquivo inteiro fica no _sre (C), sem laço por linha em Python.
+# Início de linha = após \n (re.M) ou após um \r solto (arquivos só com CR)
+_REGISTRO_RE = re.compile(rb"(?:^|(?<=\r))[0-9]{9}[^\r\n]+", re.M)
 
-def _is_digits(s: str) -> bool:
+def _is_digits(s: str | bytes) -> bool:
     return s.isdigit()
 
-def _slice(line: str, a: int, b: int) -> str:
-    return line[a-1:b]
+def _slice(line: bytes, a: int, b: int) -> str:
+    return line[a-1:b].decode("latin-1")
 
 def _ddmmaaaa_to_iso(d: str) -> Optional[str]:
     if len(d) == 8 and _is_digits(d):
@@ -35,37 +43,68 @@ def _hhmm_to_hhmm(h: str) -> Optional[str]:
         return f"{h[:2]}:{h[2:4]}"
     return None
 
+# compilados no import: evita a busca no cache do `re` a cada chamada
+_ISO_D_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_ISO_DH_RE = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:00[+-]\d{4}")
+
 def _is_iso_d(s: str) -> bool:
-    return bool(re.fullmatch(r"\d{4}-\d{2}-\d{2}", s))
+    return _ISO_D_RE.fullmatch(s) is not None
 
 def _is_iso_dh(s: str) -> bool:
-    return bool(re.fullmatch(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:00[+-]\d{4}", s))
+    return _ISO_DH_RE.fullmatch(s) is not None
 
 # =========================
 # CRC-16/IBM (ARC)
 # =========================
-def crc16_ibm_arc(data: bytes) -> int:
-    crc = 0x0000
-    for byte in data:
-        crc ^= byte
+def _build_crc16_arc_table(poly: int = 0xA001) -> array:
+    table = array("H", [0] * 256)
+    for i in range(256):
+        crc = i
         for _ in range(8):
             if crc & 1:
-                crc = (crc >> 1) ^ 0xA001
+                crc = (crc >> 1) ^ poly
             else:
                 crc >>= 1
-    return crc & 0xFFFF
+        table[i] = crc
+    return table
+
+# tabela de 256 entradas (Sarwate), montada uma vez no import
+_CRC16_ARC_TABLE = _build_crc16_arc_table()
+
+def _crc16_ibm_arc_update_py(crc: int, data: bytes) -> int:
+    t = _CRC16_ARC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ t[(crc ^ byte) & 0xFF]
+    return crc
+
+# implementação nativa opcional (pip install fastcrc); sem ela, usa a tabela acima
+try:
+    from fastcrc import crc16 as _fastcrc16
+
+    def _crc16_arc_update(crc: int, data: bytes) -> int:
+        return _fastcrc16.arc(data, initial=crc)
+except ImportError:
+    _crc16_arc_update = _crc16_ibm_arc_update_py
 
-def _crc16_hex4_for_line(line: str, crc_field_pos: Tuple[int, int]) -> str:
+def crc16_ibm_arc_update(crc: int, data: bytes) -> int:
+    """Continua o CRC a partir do estado `crc` (permite processar trechos separados)."""
+    return _crc16_arc_update(crc, data)
+
+def crc16_ibm_arc(data: bytes) -> int:
+    return _crc16_arc_update(0x0000, data)
+
+def _crc16_hex4_for_line(line: bytes, crc_field_pos: Tuple[int, int]) -> str:
+    # CRC de tudo menos o próprio campo, sem concatenar as duas partes
     a, b = crc_field_pos
-    left = _slice(line, 1, a-1)
-    right = _slice(line, b+1, len(line))
-    data = (left + right).encode("latin-1", errors="replace")
-    return f"{crc16_ibm_arc(data):04X}"
+    crc = crc16_ibm_arc_update(0x0000, line[:a-1])
+    if len(line) > b:
+        crc = crc16_ibm_arc_update(crc, line[b:])
+    return f"{crc:04X}"
 
 # =========================
 # Modelos
 # =========================
-@dataclass
+@dataclass(slots=True)
 class Registro1:
     nsr: int
     tipo: int
@@ -84,14 +123,15 @@ class Registro1:
     crc16: str | None
     crc_ok: bool | None
 
-@dataclass
+@dataclass(slots=True)
 class Registro2:
     nsr: int; tipo: int; dh_gravacao: str; cpf_responsavel: str
     id_empregador_tipo: str; id_empregador: str; cno_caepf: str
     razao_social: str; local_prestacao: str; crc16: str; crc_ok: bool
 
-@dataclass
-class Registro3:
+class Registro3(NamedTuple):
+    # NamedTuple (não dataclass): é o registro mais numeroso do AFD,
+    # então fica mais leve e vira dict sem o asdict recursivo
     nsr: int
     tipo: str  # '3' ou '7' etc.
     dh_marcacao: str
@@ -100,30 +140,30 @@ class Registro3:
     crc_ok: bool | None
     formato: str  # 'oficial' ou 'compacto'
 
-@dataclass
+@dataclass(slots=True)
 class Registro4:
     nsr: int; tipo: int; dh_antes: str; dh_ajustada: str; cpf_responsavel: str; crc16: str; crc_ok: bool
 
-@dataclass
+@dataclass(slots=True)
 class Registro5:
     nsr: int; tipo: int; dh_gravacao: str; operacao: str; cpf: str; nome: str; demais_dados: str; cpf_responsavel: str; crc16: str; crc_ok: bool
 
-@dataclass
+@dataclass(slots=True)
 class Registro6:
     nsr: int; tipo: int; dh_gravacao: str; tipo_evento: str
 
-@dataclass
+@dataclass(slots=True)
 class Registro7:
     nsr: int; tipo: str; dh_marcacao: str; cpf: str; dh_gravacao: str; coletor_id: str; online_offline: str; hash256: str
 
-@dataclass
+@dataclass(slots=True)
 class Registro9:
     nsr: int; qtd_tipo2: int; qtd_tipo3: int; qtd_tipo4: int; qtd_tipo5: int; qtd_tipo6: int; qtd_tipo7: int; tipo: int
 
 # =========================
 # Parsers (oficial)
 # =========================
-def parse_registro1_oficial(line: str) -> Registro1:
+def parse_registro1_oficial(line: bytes) -> Registro1:
     if len(line) < 302:
         raise ValueError(f"Tipo 1 (oficial) com tamanho {len(line)} < 302")
     nsr = int(_slice(line, 1, 9)); tipo = int(_slice(line, 10, 10))
@@ -140,7 +180,7 @@ def parse_registro1_oficial(line: str) -> Registro1:
                      data_ini, data_fim, dh_ger, versao, id_fab_tipo, id_fab, modelo,
                      crc, crc == crc_calc)
 
-def parse_registro2(line: str) -> Registro2:
+def parse_registro2(line: bytes) -> Registro2:
     if len(line) < 331: raise ValueError(f"Tipo 2 tamanho {len(line)} < 331")
     nsr = int(_slice(line, 1, 9)); tipo = int(_slice(line, 10, 10))
     dh = _slice(line, 11, 34); cpf_resp = _slice(line, 35, 48).strip()
@@ -150,15 +190,20 @@ def parse_registro2(line: str) -> Registro2:
     crc_ok = (crc == _crc16_hex4_for_line(line, (328, 331)))
     return Registro2(nsr, tipo, dh, cpf_resp, id_emp_tipo, id_emp, cno, razao, local, crc, crc_ok)
 
-def parse_registro3_oficial(line: str) -> Registro3:
+def parse_registro3_oficial(line: bytes) -> Registro3:
     if len(line) < 50: raise ValueError(f"Tipo 3 (oficial) tamanho {len(line)} < 50")
-    nsr = int(_slice(line, 1, 9)); tipo = _slice(line, 10, 10)
-    dh = _slice(line, 11, 34); cpf = _slice(line, 35, 46).strip()
-    crc = _slice(line, 47, 50).upper(); crc_ok = (crc == _crc16_hex4_for_line(line, (47, 50)))
-    if not _is_iso_dh(dh): raise ValueError(f"Tipo 3 (oficial) DH inválido: {dh!r}")
+    # registro mais numeroso: um único decode dos 50 bytes em vez de um _slice por campo;
+    # o CRC continua sobre os bytes originais
+    s = line[:50].decode("latin-1")
+    nsr = int(line[:9]); tipo = s[9]
+    dh = s[10:34]
+    # validação inline (caminho quente) e antes do CRC: DH inválido vai ao fallback sem calcular CRC
+    if _ISO_DH_RE.fullmatch(dh) is None: raise ValueError(f"Tipo 3 (oficial) DH inválido: {dh!r}")
+    cpf = s[34:46].strip()
+    crc = s[46:50].upper(); crc_ok = (crc == _crc16_hex4_for_line(line, (47, 50)))
     return Registro3(nsr, tipo, dh, cpf, crc, crc_ok, formato="oficial")
 
-def parse_registro4(line: str) -> Registro4:
+def parse_registro4(line: bytes) -> Registro4:
     if len(line) < 73: raise ValueError(f"Tipo 4 tamanho {len(line)} < 73")
     nsr = int(_slice(line, 1, 9)); tipo = int(_slice(line, 10, 10))
     dh_antes = _slice(line, 11, 34); dh_ajustada = _slice(line, 35, 58)
@@ -166,7 +211,7 @@ def parse_registro4(line: str) -> Registro4:
     crc_ok = (crc == _crc16_hex4_for_line(line, (70, 73)))
     return Registro4(nsr, tipo, dh_antes, dh_ajustada, cpf_resp, crc, crc_ok)
 
-def parse_registro5(line: str) -> Registro5:
+def parse_registro5(line: bytes) -> Registro5:
     if len(line) < 118: raise ValueError(f"Tipo 5 tamanho {len(line)} < 118")
     nsr = int(_slice(line, 1, 9)); tipo = int(_slice(line, 10, 10))
     dh = _slice(line, 11, 34); oper = _slice(line, 35, 35)
@@ -175,13 +220,13 @@ def parse_registro5(line: str) -> Registro5:
     crc = _slice(line, 115, 118).upper(); crc_ok = (crc == _crc16_hex4_for_line(line, (115, 118)))
     return Registro5(nsr, tipo, dh, oper, cpf, nome, dados, cpf_resp, crc, crc_ok)
 
-def parse_registro6(line: str) -> Registro6:
+def parse_registro6(line: bytes) -> Registro6:
     if len(line) < 36: raise ValueError(f"Tipo 6 tamanho {len(line)} < 36")
     nsr = int(_slice(line, 1, 9)); tipo = int(_slice(line, 10, 10))
     dh = _slice(line, 11, 34); tipo_evt = _slice(line, 35, 36)
     return Registro6(nsr, tipo, dh, tipo_evt)
 
-def parse_registro7(line: str) -> Registro7:
+def parse_registro7(line: bytes) -> Registro7:
     if len(line) < 137: raise ValueError(f"Tipo 7 tamanho {len(line)} < 137")
     nsr = int(_slice(line, 1, 9)); tipo = _slice(line, 10, 10)
     dh = _slice(line, 11, 34); cpf = _slice(line, 35, 46).strip()
@@ -189,7 +234,7 @@ def parse_registro7(line: str) -> Registro7:
     h = _slice(line, 74, 137).strip()
     return Registro7(nsr, tipo, dh, cpf, dh_grav, coletor, onoff, h)
 
-def parse_registro9(line: str) -> Registro9:
+def parse_registro9(line: bytes) -> Registro9:
     if len(line) < 64: raise ValueError(f"Tipo 9 tamanho {len(line)} < 64")
     nsr = int(_slice(line, 1, 9)); q2 = int(_slice(line, 10, 18)); q3 = int(_slice(line, 19, 27))
     q4 = int(_slice(line, 28, 36)); q5 = int(_slice(line, 37, 45)); q6 = int(_slice(line, 46, 54)); q7 = int(_slice(line, 55, 63))
@@ -200,12 +245,12 @@ def parse_registro9(line: str) -> Registro9:
 # Parsers (fallback compacto)
 # =========================
 
-def parse_registro1_compacto(line: str) -> Registro1:
+def parse_registro1_compacto(line: bytes) -> Registro1:
     """Header compacto: pega as 3 datas + hora nos últimos 28 dígitos."""
     if len(line) < 9+1+28:
         raise ValueError(f"Tipo 1 compacto muito curto: {len(line)}")
-    nsr = int(line[:9]); tipo = int(line[9])
-    trail = line[-28:]
+    nsr = int(line[:9]); tipo = int(line[9:10])
+    trail = line[-28:].decode("latin-1")
     if not _is_digits(trail):
         raise ValueError("Tipo 1 compacto sem bloco final de 28 dígitos")
     di, df, dg, hg = trail[0:8], trail[8:16], trail[16:24], trail[24:28]
@@ -220,98 +265,113 @@ def parse_registro1_compacto(line: str) -> Registro1:
         crc16=None, crc_ok=None
     )
 
-def parse_registro3_compacto(line: str) -> Registro3:
+def parse_registro3_compacto(line: bytes) -> Registro3:
     """Tipo 3 compacto: NSR(9)+3(1)+DDMMAAAA(8)+HHMM(4)+CPF/PIS(12) => >=34"""
     if len(line) < 34:
         raise ValueError(f"Tipo 3 compacto muito curto: {len(line)}")
-    nsr = int(line[:9]); tipo = line[9]
-    d, h, cpf = line[10:18], line[18:22], line[22:34].strip()
-    di = _ddmmaaaa_to_iso(d); hh = _hhmm_to_hhmm(h)
-    if not di or not hh:
-        raise ValueError(f"Tipo 3 compacto com data/hora inválidas: {d} {h}")
-    dh = f"{di}T{hh}:00-0300"
+    # laço quente dos AFDs compactos: um único decode e offsets fixos,
+    # sem passar por _ddmmaaaa_to_iso/_hhmm_to_hhmm
+    s = line[:34].decode("latin-1")
+    if not line[10:22].isdigit():
+        raise ValueError(f"Tipo 3 compacto com data/hora inválidas: {s[10:18]} {s[18:22]}")
+    nsr = int(s[:9]); tipo = s[9]; cpf = s[22:34].strip()
+    dh = f"{s[14:18]}-{s[12:14]}-{s[10:12]}T{s[18:20]}:{s[20:22]}:00-0300"
     return Registro3(nsr, tipo, dh, cpf, crc16=None, crc_ok=None, formato="compacto")
 
+# =========================
+# Despacho por tipo
+# =========================
+def _parse_registro1(line: bytes) -> Registro1:
+    # tenta oficial; se falhar, tenta compacto
+    try:
+        return parse_registro1_oficial(line)
+    except Exception as e1:
+        try:
+            return parse_registro1_compacto(line)
+        except Exception as e2:
+            raise ValueError(f"Falha no tipo 1: {e1} | fallback: {e2}")
+
+def _parse_registro3(line: bytes) -> Registro3:
+    # tenta oficial; se falhar, tenta compacto
+    try:
+        return parse_registro3_oficial(line)
+    except Exception as e1:
+        try:
+            return parse_registro3_compacto(line)
+        except Exception as e2:
+            raise ValueError(f"Falha no tipo 3: {e1} | fallback: {e2}")
+
+# tipo (10ª coluna) -> parser; um lookup por linha em vez da cadeia de if/elif
+_PARSERS: Dict[str, Callable[[bytes], Any]] = {
+    "1": _parse_registro1,
+    "2": parse_registro2,
+    "3": _parse_registro3,
+    "4": parse_registro4,
+    "5": parse_registro5,
+    "6": parse_registro6,
+    "7": parse_registro7,
+    "9": parse_registro9,
+}
+
 # =========================
 # Pipeline principal
 # =========================
+def _para_dicts(regs: list) -> List[Dict[str, Any]]:
+    # campos resolvidos uma vez por lista; asdict é recursivo e lento por registro
+    if not regs:
+        return []
+    campos = tuple(f.name for f in fields(regs[0]))
+    valores = attrgetter(*campos)
+    return [dict(zip(campos, valores(r))) for r in regs]
+
 def interpretar_afd(path: Path) -> Dict[str, Any]:
-    text = _read_text_afd(path)
-    lines = _split_lines(text)
-    if not lines:
+    raw = _read_bytes_afd(path)
+    if not raw.strip():
         raise ValueError("Arquivo vazio")
 
-    registros: List[Tuple[int, str]] = []
+    registros: List[bytes] = _REGISTRO_RE.findall(raw)
     erros: List[str] = []
 
-    for ln in lines:
-        if len(ln) < 10 or not _is_digits(ln[:9]):
-            erros.append(f"Linha inválida (sem NSR): {ln!r}")
-            continue
-        registros.append((int(ln[:9]), ln))
+    # o que sobra sem os registros são as linhas inválidas (em geral, só quebras de linha)
+    for ln in _REGISTRO_RE.sub(b"", raw).splitlines():
+        if ln.strip():
+            erros.append(f"Linha inválida (sem NSR): {ln.decode('latin-1')!r}")
 
-    # checagem simples de ordem
-    ordem_nsr_ok = [n for n,_ in registros] == sorted(n for n,_ in registros)
+    # checagem simples de ordem: NSR tem largura fixa, então comparar os
+    # 9 bytes equivale a comparar os números (e é linear, sem sorted)
+    nsrs = [ln[:9] for ln in registros]
+    ordem_nsr_ok = all(map(le, nsrs, nsrs[1:]))
 
     header: Optional[Registro1] = None
     bucket: Dict[str, list] = {k: [] for k in ("2","3","4","5","6","7")}
     trailer: Optional[Registro9] = None
     crc_ok_por_tipo: Dict[str, List[bool]] = {k: [] for k in ("1","2","3","4","5")}
 
-    for _, line in registros:
-        tipo = line[9]
+    for line in registros:
+        tipo = _slice(line, 10, 10)
+        parse = _PARSERS.get(tipo)
+        if parse is None:
+            erros.append(f"Tipo desconhecido: {tipo}")
+            continue
 
         try:
-            if tipo == "1":
-                # tenta oficial; se falhar, tenta compacto
-                try:
-                    r = parse_registro1_oficial(line)
-                except Exception as e1:
-                    try:
-                        r = parse_registro1_compacto(line)
-                    except Exception as e2:
-                        raise ValueError(f"Falha no tipo 1: {e1} | fallback: {e2}")
-                header = r
-                if r.crc_ok is not None:
-                    crc_ok_por_tipo["1"].append(r.crc_ok)
-
-            elif tipo == "2":
-                r = parse_registro2(line); bucket["2"].append(r); crc_ok_por_tipo["2"].append(r.crc_ok)
-
-            elif tipo == "3":
-                # tenta oficial; se falhar, tenta compacto
-                try:
-                    r = parse_registro3_oficial(line)
-                except Exception as e1:
-                    try:
-                        r = parse_registro3_compacto(line)
-                    except Exception as e2:
-                        raise ValueError(f"Falha no tipo 3: {e1} | fallback: {e2}")
-                bucket["3"].append(r)
-                if r.crc_ok is not None:
-                    crc_ok_por_tipo["3"].append(r.crc_ok)
-
-            elif tipo == "4":
-                r = parse_registro4(line); bucket["4"].append(r); crc_ok_por_tipo["4"].append(r.crc_ok)
-
-            elif tipo == "5":
-                r = parse_registro5(line); bucket["5"].append(r); crc_ok_por_tipo["5"].append(r.crc_ok)
-
-            elif tipo == "6":
-                r = parse_registro6(line); bucket["6"].append(r)
-
-            elif tipo == "7":
-                r = parse_registro7(line); bucket["7"].append(r)
-
-            elif tipo == "9":
-                trailer = parse_registro9(line)
-
-            else:
-                erros.append(f"Tipo desconhecido: {tipo}")
-
+            r = parse(line)
         except Exception as e:
             # não para o processamento por causa de uma linha
-            erros.append(f"Erro ao parsear NSR {line[:9]} (tipo {tipo}): {e}")
+            erros.append(f"Erro ao parsear NSR {_slice(line, 1, 9)} (tipo {tipo}): {e}")
+            continue
+
+        destino = bucket.get(tipo)
+        if destino is not None:
+            destino.append(r)
+        elif tipo == "1":
+            header = r
+        else:  # "9"
+            trailer = r
+
+        crc_ok = crc_ok_por_tipo.get(tipo)
+        if crc_ok is not None and r.crc_ok is not None:
+            crc_ok.append(r.crc_ok)
 
     contagens_ok = True
     if trailer:
@@ -331,7 +391,10 @@ def interpretar_afd(path: Path) -> Dict[str, Any]:
 
     return {
         "header": asdict(header) if header else None,
-        "registros_por_tipo": {k: [asdict(x) for x in v] for k, v in bucket.items()},
+        "registros_por_tipo": {
+            k: [r._asdict() for r in v] if k == "3" else _para_dicts(v)
+            for k, v in bucket.items()
+        },
         "trailer": asdict(trailer) if trailer else None,
         "validacoes": {
             "ordem_nsr_ok": ordem_nsr_ok,
@@ -343,26 +406,63 @@ def interpretar_afd(path: Path) -> Dict[str, Any]:
 
 def salvar_json_interpretacao(data: Dict[str, Any], out_path: Path) -> Path:
     out_path.parent.mkdir(parents=True, exist_ok=True)
+    # JSON compacto (sem indent): metade do tamanho e do tempo de escrita
+    if orjson is not None:
+        out_path.write_bytes(orjson.dumps(data))
+        return out_path
     with out_path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
     return out_path
 
-def exportar_marcacoes_tipo3_csv(data: Dict[str, Any], out_path: Path) -> Path:
+_CSV_LINHAS_POR_BLOCO = 16_384  # ~1 MB por write nos CSVs
+
+def gravar_csv_em_blocos(
+    f,
+    cols: List[str],
+    itens: Iterable[Any],
+    formatar: Callable[[Any], str] = ";".join,
+    campos: Optional[Callable[[Any], Any]] = None,
+) -> None:
+    """
+    Grava cabeçalho + `itens` num CSV ';' já aberto (newline="").
+    Cada item vira uma linha por `formatar`, gravada em blocos de ~1 MB com
+    terminador \r\n, como no csv; só as linhas com ';' ou aspas em algum campo
+    (p.ex. um CPF mal formado) passam pelo csv.writer, com os valores de `campos(item)`
+    (por padrão o próprio item).
+    """
     import csv
+    w = csv.writer(f, delimiter=';', quoting=csv.QUOTE_MINIMAL)
+    n_sep = len(cols) - 1
+    buf = [";".join(cols)]
+
+    def descarregar() -> None:
+        if buf:
+            f.write("\r\n".join(buf))
+            f.write("\r\n")
+            buf.clear()
+
+    for item in itens:
+        linha = formatar(item)
+        if linha.count(";") != n_sep or '"' in linha:
+            descarregar()
+            w.writerow(item if campos is None else campos(item))
+            continue
+        buf.append(linha)
+        if len(buf) >= _CSV_LINHAS_POR_BLOCO:
+            descarregar()
+    descarregar()
+
+def _linha_tipo3(r: Dict[str, Any]) -> str:
+    # None vira "", como no csv
+    crc_ok = r["crc_ok"]
+    return (f"{r['nsr']};{r['dh_marcacao']};{r['cpf']};{r['crc16'] or ''};"
+            f"{'' if crc_ok is None else crc_ok};{r['formato']}")
+
+def exportar_marcacoes_tipo3_csv(data: Dict[str, Any], out_path: Path) -> Path:
     regs = data.get("registros_por_tipo", {}).get("3", [])
     cols = ["nsr", "dh_marcacao", "cpf", "crc16", "crc_ok", "formato"]
     out_path.parent.mkdir(parents=True, exist_ok=True)
     # BOM UTF-8 para o Excel reconhecer encoding; delimitador ';' para locale pt-BR
     with out_path.open("w", newline="", encoding="utf-8-sig") as f:
-        w = csv.DictWriter(f, fieldnames=cols, delimiter=';', quoting=csv.QUOTE_MINIMAL)
-        w.writeheader()
-        for r in regs:
-            w.writerow({
-                "nsr": r.get("nsr"),
-                "dh_marcacao": r.get("dh_marcacao"),
-                "cpf": r.get("cpf"),
-                "crc16": r.get("crc16"),
-                "crc_ok": r.get("crc_ok"),
-                "formato": r.get("formato"),
-            })
+        gravar_csv_em_blocos(f, cols, regs, _linha_tipo3, itemgetter(*cols))
     return out_path
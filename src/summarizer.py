@@ -3,14 +3,36 @@ from __future__ import annotations
 from pathlib import Path
 from typing import List, Tuple, Dict, Any, Optional
 import csv
-from datetime import datetime, timedelta
+from itertools import groupby, zip_longest
+from operator import itemgetter
+from datetime import datetime, timedelta, timezone
+
+from .processor import gravar_csv_em_blocos
 
 # Quantos pares (entrada/saída) expor no CSV final
 N_PARES = 4  # mude para 2 se quiser só entrada1/saida1/entrada2/saida2
 
+# fusos já vistos (offset em minutos -> tzinfo); na prática só -0300
+_TZ_CACHE: Dict[int, timezone] = {}
+
 def _parse_iso_dh(s: str) -> datetime:
-    # Ex.: 2025-07-16T18:22:00-0300
-    return datetime.strptime(s, "%Y-%m-%dT%H:%M:00%z")
+    # Ex.: 2025-07-16T18:22:00-0300 (layout fixo gerado pelo processor;
+    # fatiar à mão é bem mais rápido que strptime neste laço)
+    if (
+        len(s) != 24 or not s.isascii()
+        or s[4] + s[7] + s[10] + s[13] + s[16:19] != "--T::00" or s[19] not in "+-"
+        # int() aceitaria '+', '_' e espaços: exige só dígitos nos campos numéricos
+        or not (s[0:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16] + s[20:24]).isdigit()
+        or int(s[22:24]) >= 60
+    ):
+        raise ValueError(f"Data/hora fora do formato: {s!r}")
+    off = int(s[20:22]) * 60 + int(s[22:24])
+    if s[19] == "-":
+        off = -off
+    tz = _TZ_CACHE.get(off)
+    if tz is None:
+        tz = _TZ_CACHE.setdefault(off, timezone(timedelta(minutes=off)))
+    return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), tzinfo=tz)
 
 def _format_dh(dt: Optional[datetime]) -> str:
     return dt.strftime("%Y-%m-%d %H:%M") if dt else ""
@@ -25,16 +47,10 @@ def _format_td_hhmm(td: timedelta) -> str:
 
 def _sum_pairs(times: List[datetime]) -> Tuple[timedelta, List[Tuple[Optional[datetime], Optional[datetime]]]]:
     """Cria pares (E,S) ordenados; pares incompletos não entram no total."""
-    pares: List[Tuple[Optional[datetime], Optional[datetime]]] = []
-    total = timedelta(0)
-    i = 0
-    while i < len(times):
-        e = times[i]
-        s = times[i+1] if i + 1 < len(times) else None
-        pares.append((e, s))
-        if s and s > e:
-            total += (s - e)
-        i += 2
+    # fatias pares/ímpares + zip: o laço fica no C, sem índices em Python
+    entradas, saidas = times[0::2], times[1::2]
+    pares: List[Tuple[Optional[datetime], Optional[datetime]]] = list(zip_longest(entradas, saidas))
+    total = sum((s - e for e, s in zip(entradas, saidas) if s > e), timedelta(0))
     return total, pares
 
 def carregar_marcacoes_csv(path_csv: Path) -> List[Dict[str, Any]]:
@@ -46,6 +62,34 @@ def carregar_marcacoes_csv(path_csv: Path) -> List[Dict[str, Any]]:
             rows.append(row)
     return rows
 
+def _ler_marcacoes_csv(path_csv: Path) -> List[Tuple[str, str, datetime]]:
+    """
+    Lê só as colunas cpf/dh_marcacao do CSV de marcações e devolve
+    (cpf, data local ISO, datetime); linhas sem CPF ou com data inválida são ignoradas.
+    """
+    out: List[Tuple[str, str, datetime]] = []
+    with path_csv.open("r", encoding="utf-8-sig", newline="") as f:
+        r = csv.reader(f, delimiter=';')
+        header = next(r, [])
+        if "cpf" not in header or "dh_marcacao" not in header:
+            return out
+        i_cpf, i_dh = header.index("cpf"), header.index("dh_marcacao")
+        n_min = max(i_cpf, i_dh) + 1
+        for row in r:
+            if len(row) < n_min:
+                continue
+            cpf = row[i_cpf].strip()
+            dh = row[i_dh].strip()
+            if not cpf or not dh:
+                continue
+            try:
+                dt = _parse_iso_dh(dh)
+            except Exception:
+                continue
+            # Data local já considerando o TZ do carimbo
+            out.append((cpf, dt.date().isoformat(), dt))
+    return out
+
 def gerar_jornadas_por_cpf(
     path_csv_marcacoes: Path,
     out_path: Path,
@@ -58,23 +102,13 @@ def gerar_jornadas_por_cpf(
     - Ordena por data e CPF (ou CPF e data).
     - Pares incompletos não entram no somatório.
     """
-    dados = carregar_marcacoes_csv(path_csv_marcacoes)
-
-    # Agrupar por (cpf, data local)
-    from collections import defaultdict
-    buckets: Dict[Tuple[str, str], List[datetime]] = defaultdict(list)
-    for row in dados:
-        cpf = (row.get("cpf") or "").strip()
-        dh = (row.get("dh_marcacao") or "").strip()
-        if not cpf or not dh:
-            continue
-        try:
-            dt = _parse_iso_dh(dh)
-        except Exception:
-            continue
-        # Data local já considerando o TZ do carimbo
-        data_local = dt.astimezone(dt.tzinfo).date().isoformat()
-        buckets[(cpf, data_local)].append(dt)
+    # Uma única ordenação (C) por (cpf, data, hora) ou (data, cpf, hora) deixa cada
+    # CPF+dia contíguo e já na ordem de saída; o agrupamento vira um groupby linear
+    marcacoes = _ler_marcacoes_csv(path_csv_marcacoes)
+    if ordenar_por == "cpf_data":
+        marcacoes.sort()
+    else:  # padrão: data, depois CPF
+        marcacoes.sort(key=itemgetter(1, 0, 2))
 
     # Colunas de saída
     cols = ["cpf", "data"]
@@ -82,43 +116,31 @@ def gerar_jornadas_por_cpf(
         cols += [f"entrada{i}", f"saida{i}"]
     cols += ["horas_trabalhadas", "horas_extras_maior_10h", "horas_extras_maior_6h"]
 
-    # Montar linhas
-    linhas: List[Dict[str, Any]] = []
-    for (cpf, data_str), times in buckets.items():
-        times.sort()
+    # Montar linhas (tuplas na ordem de `cols`, sem dict por linha)
+    limite_10h = timedelta(hours=10)
+    limite_6h  = timedelta(hours=6)
+    n_campos_pares = 2 * n_pares
+    linhas: List[Tuple[str, ...]] = []
+    for (cpf, data_str), grupo in groupby(marcacoes, key=itemgetter(0, 1)):
+        times = [m[2] for m in grupo]
         total, pares = _sum_pairs(times)
 
         # Calcular extras com dois limiares independentes
-        limite_10h = timedelta(hours=10)
-        limite_6h  = timedelta(hours=6)
         extra_10h = total - limite_10h if total > limite_10h else timedelta(0)
         extra_6h  = total - limite_6h  if total > limite_6h  else timedelta(0)
 
-        row: Dict[str, Any] = {"cpf": cpf, "data": data_str}
-        for i in range(n_pares):
-            e = pares[i][0] if i < len(pares) else None
-            s = pares[i][1] if i < len(pares) else None
-            row[f"entrada{i+1}"] = _format_dh(e) if e else ""
-            row[f"saida{i+1}"]   = _format_dh(s) if s else ""
-
-        row["horas_trabalhadas"]      = _format_td_hhmm(total)
-        row["horas_extras_maior_10h"] = _format_td_hhmm(extra_10h)
-        row["horas_extras_maior_6h"]  = _format_td_hhmm(extra_6h)
+        # entrada1, saida1, ... (saída ausente vira ""), completando até n_pares
+        horarios = [_format_dh(dt) for par in pares[:n_pares] for dt in par]
+        horarios += [""] * (n_campos_pares - len(horarios))
 
-        linhas.append(row)
-
-    # Ordenar saída
-    if ordenar_por == "cpf_data":
-        linhas.sort(key=lambda r: (r["cpf"], r["data"]))
-    else:  # padrão: data, depois CPF
-        linhas.sort(key=lambda r: (r["data"], r["cpf"]))
+        linhas.append((
+            cpf, data_str, *horarios,
+            _format_td_hhmm(total), _format_td_hhmm(extra_10h), _format_td_hhmm(extra_6h),
+        ))
 
     # Salvar CSV final
     out_path.parent.mkdir(parents=True, exist_ok=True)
     with out_path.open("w", encoding="utf-8-sig", newline="") as f:
-        w = csv.DictWriter(f, fieldnames=cols, delimiter=';')
-        w.writeheader()
-        for row in linhas:
-            w.writerow(row)
+        gravar_csv_em_blocos(f, cols, linhas)
 
     return out_path